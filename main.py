@@ -1,14 +1,17 @@
 import os
 import json
+import time
+import hashlib
+import asyncio
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import sqlite3
+
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-import openai
+
+# matplotlib, scikit-learn and openai are imported inside the functions that use them,
+# so the main window appears without paying for their import time.
 
 # Load configuration from config.json
 CONFIG_FILE = "config.json"
@@ -20,18 +23,79 @@ else:
     exit(1)
 
 # Set OpenAI API key from the configuration
-openai.api_key = config.get("openai_api_key", "")
-if not openai.api_key:
+OPENAI_API_KEY = config.get("openai_api_key", "")
+if not OPENAI_API_KEY:
     messagebox.showerror("Configuration Error", "OpenAI API key not found in config.json")
     exit(1)
 
+# Static instructions for the OpenAI correlation analysis. Kept byte-identical across calls
+# and sent ahead of the ticket data so the API's automatic prompt caching can reuse it.
+STATIC_INSTRUCTIONS = (
+    "You are an expert in support ticket analysis. Below is a sample of support ticket data. "
+    "Each record includes a unique ticket number, title, and description. Your task is to analyze the text and correlate "
+    "the tickets by identifying the main issue types and any mentions of specific workstations or robots. Use the ticket "
+    "numbers to precisely count how many tickets are correlated with each other.\n\n"
+    "Please group the tickets into distinct categories based on these criteria and count the number of tickets in each category. "
+    "Also, provide a brief summary of the key findings and recommendations for reducing ticket numbers. \n\n"
+    "Return your answer as a valid JSON object with the following structure:\n\n"
+    "{\n"
+    '  "categories": {\n'
+    '      "<Category Name>": <Count>,\n'
+    '      "...": ...\n'
+    "  },\n"
+    '  "summary": "<A short summary of your findings and recommendations>"\n'
+    "}"
+)
+
 # Set the SQLite database name from configuration
 DB_NAME = config.get("db_name", "tickets.db")
 
+# Single connection shared for the lifetime of the process. All database access happens
+# on the Tk mainloop thread, so the page cache and pragmas are set up only once.
+DB = sqlite3.connect(DB_NAME)
+
+# Number of tickets read from SQLite at a time when building the clustering features
+TEXT_CHUNK_SIZE = 10_000
+
+# Minimum number of tickets with a title or description needed to run clustering
+MIN_CLUSTER_TEXTS = 10
+
+# Seconds a cached OpenAI response stays valid
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Directory for the fitted TF-IDF and clustering models reused across runs
+MODEL_CACHE_DIR = ".cache"
+
+def model_cache_path(row_count, max_id, vectorizer, kmeans):
+    """
+    Returns the cache file path for the fitted clustering models. The name is derived from
+    the ticket table state, the (unfitted) model parameters and the scikit-learn version,
+    so any change invalidates it.
+    """
+    import sklearn
+    
+    sig = hashlib.md5(str((DB_NAME, row_count, max_id, sklearn.__version__,
+                           repr(vectorizer), repr(kmeans))).encode("utf-8")).hexdigest()
+    return os.path.join(MODEL_CACHE_DIR, f"tfidf_{sig}.pkl")
+
+def save_cached_models(model_path, vectorizer, kmeans):
+    """Saves the fitted models, removing cache files from previous ticket table states."""
+    import joblib
+    
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    for name in os.listdir(MODEL_CACHE_DIR):
+        if name.startswith("tfidf_") and name.endswith(".pkl"):
+            os.remove(os.path.join(MODEL_CACHE_DIR, name))
+    joblib.dump((vectorizer, kmeans), model_path)
+
 def create_database():
     """Creates the SQLite database and the tickets table with correct column names."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    # WAL + NORMAL sync avoids an fsync on every commit; the other pragmas apply to this connection
+    DB.execute("PRAGMA journal_mode=WAL")
+    DB.execute("PRAGMA synchronous=NORMAL")
+    DB.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+    DB.execute("PRAGMA temp_store=MEMORY")
+    cursor = DB.cursor()
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS tickets (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -49,8 +113,31 @@ def create_database():
         category TEXT
     )
     """)
-    conn.commit()
-    conn.close()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_category ON tickets(category)")
+    # Re-uploading a file must not duplicate tickets. Databases created before the unique
+    # index existed may already contain duplicates, so keep the first copy of each ticket.
+    has_ticket_index = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_ticket_no'"
+    ).fetchone()
+    if not has_ticket_index:
+        cursor.execute("""
+        DELETE FROM tickets
+        WHERE ticket_no IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM tickets WHERE ticket_no IS NOT NULL GROUP BY ticket_no
+        )
+        """)
+        if cursor.rowcount > 0:
+            print(f"Removed {cursor.rowcount} duplicate tickets before adding the ticket_no unique index")
+        cursor.execute("CREATE UNIQUE INDEX idx_ticket_no ON tickets(ticket_no)")
+    # Cache of OpenAI responses keyed by a hash of the request parameters
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        response TEXT,
+        ts INTEGER
+    )
+    """)
+    DB.commit()
 
 def load_and_store_data(file_path):
     """
@@ -73,23 +160,55 @@ def load_and_store_data(file_path):
         "完成时长(Complete duration)": "complete_duration"
     }
     data_list = []
-    for sheet_name in sheets:
-        try:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-            available_cols = [col for col in columns_map.keys() if col in df.columns]
-            df = df[available_cols]
-            df = df.rename(columns=columns_map)  # Rename columns to English names
-            df["category"] = sheet_name  # Add category column based on the sheet
-            data_list.append(df)
-        except Exception as e:
-            print(f"Error processing sheet {sheet_name}: {e}")
+    # Open the workbook once with the Rust-based calamine reader and parse each sheet from it.
+    # Sheets are parsed one at a time because the calamine workbook is not safe to share
+    # across threads.
+    try:
+        xl = pd.ExcelFile(file_path, engine="calamine")
+    except Exception as e:
+        messagebox.showerror("Error", f"Could not open {file_path}: {e}")
+        return
+    with xl:
+        for sheet_name in sheets:
+            if sheet_name not in xl.sheet_names:
+                print(f"Error processing sheet {sheet_name}: sheet not found")
+                continue
+            try:
+                # Only parse the needed columns, as text, to skip dtype inference
+                df = xl.parse(sheet_name, usecols=lambda col: col in columns_map, dtype=str)
+                df = df.rename(columns=columns_map)  # Rename columns to English names
+                df["category"] = sheet_name  # Add category column based on the sheet
+                data_list.append(df)
+            except Exception as e:
+                print(f"Error processing sheet {sheet_name}: {e}")
     
     if data_list:
-        all_data = pd.concat(data_list, ignore_index=True)
-        conn = sqlite3.connect(DB_NAME)
-        all_data.to_sql("tickets", conn, if_exists="append", index=False)
-        conn.close()
-        messagebox.showinfo("Success", "Data loaded and stored successfully!")
+        columns = list(columns_map.values()) + ["category"]
+        all_data = pd.concat(data_list, ignore_index=True).reindex(columns=columns)
+        # The unique index cannot deduplicate tickets without a number (NULLs never collide),
+        # so such rows are skipped and reported
+        has_ticket_no = all_data["ticket_no"].fillna("").str.strip() != ""
+        missing = int((~has_ticket_no).sum())
+        all_data = all_data[has_ticket_no].astype(object)
+        all_data = all_data.where(all_data.notna(), None)
+        # Insert everything in one transaction. INSERT OR IGNORE lets the unique ticket_no
+        # index skip tickets that are already stored.
+        placeholders = ", ".join("?" for _ in columns)
+        DB.execute("BEGIN")
+        try:
+            cursor = DB.executemany(
+                f"INSERT OR IGNORE INTO tickets ({', '.join(columns)}) VALUES ({placeholders})",
+                all_data.itertuples(index=False, name=None),
+            )
+            inserted = cursor.rowcount
+            DB.commit()
+        except Exception:
+            DB.rollback()
+            raise
+        skipped = len(all_data) - inserted
+        messagebox.showinfo("Success", "Data loaded and stored successfully!\n"
+                            f"{inserted} new tickets stored, {skipped} duplicates skipped, "
+                            f"{missing} rows without a ticket number skipped.")
     else:
         messagebox.showerror("Error", "No data loaded from file.")
 
@@ -97,20 +216,27 @@ def analyze_data():
     """
     Performs local analysis on the ticket data:
     - Ticket count per category.
-    - Text clustering analysis using TF-IDF and KMeans on Title and Description.
+    - Text clustering analysis using hashed TF-IDF features and MiniBatchKMeans on Title and Description.
     Displays results in a new dashboard window.
     """
-    conn = sqlite3.connect(DB_NAME)
-    df = pd.read_sql_query("SELECT * FROM tickets", conn)
-    conn.close()
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+    from sklearn.pipeline import make_pipeline
+    from sklearn.cluster import MiniBatchKMeans
+    from scipy import sparse
+    import numpy as np
+    import joblib
     
-    if df.empty:
+    # Let SQLite aggregate the counts from the category index instead of loading every row
+    category_counts = pd.read_sql_query(
+        "SELECT category, COUNT(*) AS n FROM tickets GROUP BY category ORDER BY n DESC", DB
+    ).set_index("category")["n"]
+    
+    if category_counts.empty:
         messagebox.showerror("Error", "No data available for analysis.")
         return
     
-    # Use the lowercase "category" column
-    category_counts = df["category"].value_counts()
-    
     dashboard = tk.Toplevel()
     dashboard.title("Dashboard - Local Analysis")
     
@@ -121,18 +247,58 @@ def analyze_data():
     axs[0].set_ylabel("Count")
     
     # Analysis 2: Text clustering using renamed columns (title and description)
-    df['combined_text'] = df['title'].fillna('') + " " + df['description'].fillna('')
-    vectorizer = TfidfVectorizer(stop_words='english')
-    try:
-        X = vectorizer.fit_transform(df['combined_text'])
-    except Exception as e:
-        X = None
+    # The text corpus is only needed here. It is streamed from SQLite in chunks so only
+    # one chunk of text is held in memory at a time.
+    max_id, row_count, text_count = DB.execute(
+        "SELECT MAX(id), COUNT(*), "
+        "SUM(COALESCE(title, '') <> '' OR COALESCE(description, '') <> '') FROM tickets"
+    ).fetchone()
+    
+    def iter_text_chunks():
+        for chunk in pd.read_sql_query("SELECT title, description FROM tickets", DB,
+                                       chunksize=TEXT_CHUNK_SIZE):
+            yield chunk['title'].str.cat(chunk['description'], sep=' ', na_rep='')
     
-    if X is not None and X.shape[0] > 0:
-        kmeans = KMeans(n_clusters=3, random_state=42)
-        clusters = kmeans.fit_predict(X)
-        df['Cluster'] = clusters
-        cluster_counts = df['Cluster'].value_counts()
+    cluster_counts = None
+    clusters = None
+    # Clustering only a handful of tickets is meaningless, so skip vectorizing and fitting
+    if text_count >= MIN_CLUSTER_TEXTS:
+        # Fewer clusters for small corpora so none of them end up empty
+        n_clusters = min(3, max(2, text_count // 4))
+        # Hashing is stateless, so only the IDF weights need the whole corpus.
+        # float32 features stay sparse throughout and halve the memory traffic in MiniBatchKMeans.
+        vectorizer = make_pipeline(
+            HashingVectorizer(n_features=2**18, alternate_sign=False, stop_words='english',
+                              dtype=np.float32),
+            TfidfTransformer(sublinear_tf=True),
+        )
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, batch_size=1024, n_init="auto")
+        
+        # Reuse the fitted models if the ticket table has not changed since they were saved
+        model_path = model_cache_path(row_count, max_id, vectorizer, kmeans)
+        if os.path.exists(model_path):
+            try:
+                cached_vectorizer, cached_kmeans = joblib.load(model_path)
+                clusters = np.concatenate([cached_kmeans.predict(cached_vectorizer.transform(text))
+                                           for text in iter_text_chunks()])
+            except Exception as e:
+                # A truncated or incompatible cache file is discarded and the models refit
+                print(f"Discarding unusable model cache {model_path}: {e}")
+                os.remove(model_path)
+        if clusters is None:
+            hasher, tfidf = vectorizer[0], vectorizer[1]
+            try:
+                X = tfidf.fit_transform(sparse.vstack([hasher.transform(text)
+                                                       for text in iter_text_chunks()]))
+            except Exception as e:
+                X = None
+            
+            if X is not None and X.shape[0] > 0:
+                clusters = kmeans.fit_predict(X)
+                save_cached_models(model_path, vectorizer, kmeans)
+    
+    if clusters is not None:
+        cluster_counts = pd.Series(clusters).value_counts()
         axs[1].bar(cluster_counts.index.astype(str), cluster_counts.values, color='salmon')
         axs[1].set_title("Ticket Clusters (Based on Title & Description)")
         axs[1].set_xlabel("Cluster")
@@ -148,74 +314,169 @@ def analyze_data():
     
     summary_text = tk.Text(dashboard, height=10, width=80)
     summary_text.pack(pady=10)
-    summary_text.insert(tk.END, "Local Analysis Summary:\n")
-    summary_text.insert(tk.END, f"Total Tickets: {len(df)}\n")
-    summary_text.insert(tk.END, "Tickets per Category:\n")
-    for category, count in category_counts.items():
-        summary_text.insert(tk.END, f"  {category}: {count}\n")
-    
-    summary_text.insert(tk.END, "\nCluster Analysis:\n")
-    if 'Cluster' in df.columns:
-        for cluster, count in cluster_counts.items():
-            summary_text.insert(tk.END, f"  Cluster {cluster}: {count}\n")
+    # Build the summary first and insert it in one call
+    lines = [
+        "Local Analysis Summary:",
+        f"Total Tickets: {category_counts.sum()}",
+        "Tickets per Category:",
+    ]
+    lines.extend(f"  {category}: {count}" for category, count in category_counts.items())
+    lines.append("")
+    lines.append("Cluster Analysis:")
+    if cluster_counts is not None:
+        lines.extend(f"  Cluster {cluster}: {count}" for cluster, count in cluster_counts.items())
     else:
-        summary_text.insert(tk.END, "  Clustering not performed.\n")
+        lines.append("  Clustering not performed.")
+    summary_text.insert(tk.END, "\n".join(lines) + "\n")
     
     summary_text.config(state=tk.DISABLED)
 
+def response_cache_key(model, messages, temperature):
+    """Returns a deterministic cache key for an OpenAI chat completion request."""
+    payload = json.dumps({"model": model, "messages": messages, "temperature": temperature},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_response(key):
+    """Returns the cached OpenAI response for the given key, or None if not cached or expired."""
+    row = DB.execute("SELECT response FROM responses WHERE key = ? AND ts >= ?",
+                     (key, int(time.time()) - RESPONSE_CACHE_TTL)).fetchone()
+    return row[0] if row else None
+
+def is_complete_analysis(analysis_response):
+    """Returns True if the response is valid JSON with a categories mapping, i.e. worth caching."""
+    try:
+        analysis_data = json.loads(analysis_response)
+    except ValueError:
+        return False
+    return isinstance(analysis_data, dict) and isinstance(analysis_data.get("categories"), dict)
+
+def store_cached_response(key, response):
+    """Stores an OpenAI response in the cache."""
+    DB.execute("INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+               (key, response, int(time.time())))
+    DB.commit()
+
 def analyze_with_openai():
     """
     Uses the OpenAI API to provide a deeper analysis on the support ticket data.
     This function aggregates ticket numbers, titles, and descriptions and sends them to OpenAI
     with instructions to correlate the tickets by issue type and by related workstation/robot.
     The API is requested to return a structured JSON containing category counts and a summary.
+    The response is streamed into the result window from a background thread.
     """
-    conn = sqlite3.connect(DB_NAME)
-    df = pd.read_sql_query("SELECT * FROM tickets", conn)
-    conn.close()
+    # Only the first 10 tickets are sent to OpenAI, so limit in SQL
+    df = pd.read_sql_query("SELECT ticket_no, title, description FROM tickets LIMIT 10", DB)
     
     if df.empty:
         messagebox.showerror("Error", "No data available for OpenAI analysis.")
         return
 
     # Use the renamed columns: ticket_no, title, and description
-    sample_texts = df.apply(lambda row: (
-        f"Ticket Number: {row['ticket_no']}\n"
-        f"Title: {row['title']}\n"
-        f"Description: {row['description']}"
-    ), axis=1)
-    text_sample = "\n\n".join(sample_texts.tolist()[:10])  # Adjust sample size as needed
-
-    # Construct the prompt for correlation analysis
-    prompt = (
-        "You are an expert in support ticket analysis. Below is a sample of support ticket data. "
-        "Each record includes a unique ticket number, title, and description. Your task is to analyze the text and correlate "
-        "the tickets by identifying the main issue types and any mentions of specific workstations or robots. Use the ticket "
-        "numbers to precisely count how many tickets are correlated with each other.\n\n"
-        "Please group the tickets into distinct categories based on these criteria and count the number of tickets in each category. "
-        "Also, provide a brief summary of the key findings and recommendations for reducing ticket numbers. \n\n"
-        "Return your answer as a valid JSON object with the following structure:\n\n"
-        "{\n"
-        '  "categories": {\n'
-        '      "<Category Name>": <Count>,\n'
-        '      "...": ...\n'
-        "  },\n"
-        '  "summary": "<A short summary of your findings and recommendations>"\n'
-        "}\n\n"
-        "Here is the sample data:\n"
-        f"{text_sample}"
+    # Sample size is set by the LIMIT above
+    text_sample = "\n\n".join(
+        f"Ticket Number: {ticket_no}\nTitle: {title}\nDescription: {description}"
+        for ticket_no, title, description in df.itertuples(index=False, name=None)
     )
+
+    # The static instructions go first so the provider can reuse the cached prompt prefix
+    model = "gpt-3.5-turbo"
+    messages = [
+        {"role": "system", "content": STATIC_INSTRUCTIONS},
+        {"role": "user", "content": f"Here is the sample data:\n{text_sample}"},
+    ]
+    temperature = 0.5
     
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
+    # Create a dashboard window for OpenAI analysis results
+    analysis_window = tk.Toplevel()
+    analysis_window.title("OpenAI Analysis Result")
+    
+    summary_label = tk.Label(analysis_window, text="OpenAI Analysis Summary:", font=("Arial", 12, "bold"))
+    summary_label.pack(pady=(10, 0))
+    result_text = tk.Text(analysis_window, wrap=tk.WORD, height=10, width=100)
+    result_text.pack(padx=10, pady=10)
+    result_text.config(state=tk.DISABLED)
+    
+    # Reuse a previous response if the exact same request was already made
+    cache_key = response_cache_key(model, messages, temperature)
+    analysis_response = get_cached_response(cache_key)
+    if analysis_response is not None:
+        show_openai_result(analysis_window, summary_label, result_text, analysis_response)
+        return
+    
+    def schedule(callback, *args):
+        # Tk widgets must only be touched from the mainloop thread
+        analysis_window.after(0, callback, *args)
+    
+    # The scheduled callbacks check the widget still exists, since the user may close the
+    # window while the response is streaming
+    def append_delta(delta):
+        if result_text.winfo_exists():
+            append_text(result_text, delta)
+    
+    def finish(analysis_response, succeeded):
+        # Runs on the mainloop, which owns the shared database connection
+        # Truncated or malformed replies are not cached so the next click retries the request
+        if succeeded and is_complete_analysis(analysis_response):
+            store_cached_response(cache_key, analysis_response)
+        if result_text.winfo_exists():
+            show_openai_result(analysis_window, summary_label, result_text, analysis_response)
+    
+    def worker():
+        # Stream the response off the mainloop so the UI stays responsive
+        try:
+            analysis_response = asyncio.run(stream_openai_response(
+                model, messages, temperature,
+                lambda delta: schedule(append_delta, delta),
+            ))
+            succeeded = True
+        except Exception as e:
+            analysis_response = f"Error in OpenAI API call: {e}"
+            succeeded = False
+        schedule(finish, analysis_response, succeeded)
+    
+    threading.Thread(target=worker, daemon=True).start()
+
+async def stream_openai_response(model, messages, temperature, on_delta):
+    """
+    Streams a chat completion from OpenAI, calling on_delta with each piece of content
+    as it arrives. Returns the full response text.
+    """
+    from openai import AsyncOpenAI
+    
+    # Close the HTTP client before asyncio.run tears down the event loop
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as client:
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
             max_tokens=400,
+            stream=True,
         )
-        analysis_response = response.choices[0].message['content']
-    except Exception as e:
-        analysis_response = f"Error in OpenAI API call: {e}"
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+    return "".join(parts)
+
+def append_text(text_widget, text):
+    """Appends text to a read-only Text widget and scrolls to the end."""
+    text_widget.config(state=tk.NORMAL)
+    text_widget.insert(tk.END, text)
+    text_widget.see(tk.END)
+    text_widget.config(state=tk.DISABLED)
+
+def show_openai_result(analysis_window, summary_label, result_text, analysis_response):
+    """
+    Parses the complete OpenAI response and renders the category chart above the summary,
+    replacing the streamed raw output with the summary text.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
     
     # Attempt to parse the API response as JSON
     try:
@@ -225,10 +486,6 @@ def analyze_with_openai():
     except Exception as e:
         categories = {}
         summary = analysis_response
-
-    # Create a dashboard window for OpenAI analysis results
-    analysis_window = tk.Toplevel()
-    analysis_window.title("OpenAI Analysis Result")
     
     if categories:
         fig, ax = plt.subplots(figsize=(6, 4))
@@ -242,15 +499,13 @@ def analyze_with_openai():
         
         canvas = FigureCanvasTkAgg(fig, master=analysis_window)
         canvas.draw()
-        canvas.get_tk_widget().pack(pady=10)
+        canvas.get_tk_widget().pack(pady=10, before=summary_label)
     else:
         label = tk.Label(analysis_window, text="No valid category data returned from OpenAI.", fg="red")
-        label.pack(pady=10)
+        label.pack(pady=10, before=summary_label)
     
-    summary_label = tk.Label(analysis_window, text="OpenAI Analysis Summary:", font=("Arial", 12, "bold"))
-    summary_label.pack(pady=(10, 0))
-    result_text = tk.Text(analysis_window, wrap=tk.WORD, height=10, width=100)
-    result_text.pack(padx=10, pady=10)
+    result_text.config(state=tk.NORMAL)
+    result_text.delete("1.0", tk.END)
     result_text.insert(tk.END, summary)
     result_text.config(state=tk.DISABLED)
 